@@ -9,13 +9,38 @@ from contextlib import contextmanager
 import threading
 import logging
 
+try:
+    from contextvars import ContextVar
+except ImportError:
+    ContextVar = None
+
 _log = logging.getLogger(__name__)
 
-_store_state = threading.local()
+
+class _LocalVar:
+    "Thread-local stand-in for :py:class:`contextvars.ContextVar` on Python 3.6."
+
+    def __init__(self, name, *, default):
+        self.name = name
+        self._default = default
+        self._local = threading.local()
+
+    def get(self):
+        return getattr(self._local, 'value', self._default)
+
+    def set(self, value):
+        token = self.get()
+        self._local.value = value
+        return token
+
+    def reset(self, token):
+        self._local.value = token
 
 
-def _save_mode():
-    return getattr(_store_state, 'mode', 'save')
+if ContextVar is not None:
+    _share_mode = ContextVar('lk_share_mode', default='save')
+else:
+    _share_mode = _LocalVar('lk_share_mode', default='save')
 
 
 @contextmanager
@@ -24,12 +49,11 @@ def sharing_mode():
     Context manager to tell models that pickling will be used for cross-process
     sharing, not model persistence.
     """
-    old = _save_mode()
-    _store_state.mode = 'share'
+    token = _share_mode.set('share')
     try:
         yield
     finally:
-        _store_state.mode = old
+        _share_mode.reset(token)
 
 
 def in_share_context():
@@ -38,7 +62,7 @@ def in_share_context():
     :func:`sharing_mode` context, which means model pickling will be used for
     cross-process sharing.
     """
-    return _save_mode() == 'share'
+    return _share_mode.get() == 'share'
 
 
 class PersistedModel(ABC):
@@ -67,6 +91,16 @@ class PersistedModel(ABC):
         """
         pass
 
+    def reclaim(self):
+        """
+        Note that every process this object was pickled to has exited, so its resources
+        are no longer visible anywhere else and can be reused once it is closed.  Called
+        by worker pools when they shut down.
+
+        The default implementation does nothing.
+        """
+        pass
+
     def transfer(self):
         """
         Mark an object for ownership transfer.  This object, when pickled, will
@@ -86,6 +120,34 @@ class PersistedModel(ABC):
         return self
 
 
+class NoopPersisted(PersistedModel):
+    """
+    A "persisted" model that just holds a reference to the model itself.
+
+    This is useful when worker processes are created with the ``fork`` start method and
+    receive the persisted object without pickling it, as they then share the parent's
+    memory pages copy-on-write.  If it is pickled (e.g. for a ``spawn`` worker), the model
+    is pickled along with it.
+    """
+
+    def __init__(self, model):
+        self._model = model
+        self.is_owner = True
+
+    def get(self):
+        return self._model
+
+    def close(self):
+        self._model = None
+        self.is_owner = False
+
+    def __getstate__(self):
+        return {
+            '_model': self._model,
+            'is_owner': True if self.is_owner == 'transfer' else False
+        }
+
+
 def persist(model, *, method=None):
     """
     Persist a model for cross-process sharing.
@@ -97,37 +159,47 @@ def persist(model, *, method=None):
     strategy from the the following, in order:
 
     1. If `LK_TEMP_DIR` is set, use :mod:`binpickle` in shareable mode to save
-       the object into the LensKit temporary directory.
+       the object into the LensKit temporary directory.  If `LK_TEMP_COMPRESS`
+       is also set, the file is compressed with that codec (see
+       :func:`persist_binpickle`).
     2. If :mod:`multiprocessing.shared_memory` is available, use :mod:`pickle`
        to save the model, placing the buffers into shared memory blocks.
     3. Otherwise, use :mod:`binpickle` in shareable mode to save the object
        into the system temporary directory.
 
+    The ``noop`` method skips serialization entirely (see :py:class:`NoopPersisted`); it is
+    never selected automatically, because LensKit's own worker pools use the ``spawn`` start
+    method.
+
     Args:
         model(obj):
             The model to persist.
         method(str or None):
-            The method to use.  Can be one of ``binpickle`` or ``shm``.
+            The method to use.  Can be one of ``binpickle``, ``shm``, or ``noop``.
 
     Returns:
         PersistedModel: The persisted object.
     """
-    if method is not None:
-        if method == 'binpickle':
-            method = persist_binpickle
-        elif method == 'shm':
-            method = persist_shm
-        elif not hasattr(method, '__call__'):
-            raise ValueError('invalid method %s: must be one of binpickle, shm, or a funciton')
-
     if method is None:
         if SHM_AVAILABLE and 'LK_TEMP_DIR' not in os.environ:
             method = persist_shm
         else:
             method = persist_binpickle
+    elif not hasattr(method, '__call__'):
+        name = method
+        method = _persist_methods.get(name, None)
+        if method is None:
+            raise ValueError('invalid method {}: must be one of {}, or a function'.format(
+                name, ', '.join(_persist_methods)))
 
     return method(model)
 
 
 from .binpickle import persist_binpickle, BPKPersisted     # noqa: E402,F401
 from .shm import persist_shm, SHMPersisted, SHM_AVAILABLE  # noqa: E402,F401
+
+_persist_methods = {
+    'binpickle': persist_binpickle,
+    'shm': persist_shm,
+    'noop': NoopPersisted,
+}
@@ -1,24 +1,77 @@
 import os
+import mmap
 import pathlib
 import tempfile
 import logging
 import gc
 
 import binpickle
+import binpickle.codecs
 
 from . import sharing_mode, PersistedModel
 
 _log = logging.getLogger(__name__)
 
 
-def persist_binpickle(model, dir=None, file=None):
+def _prefetch(bpf):
+    """
+    Ask the OS to start reading a binpickle file's mapping into the page cache, so
+    loading it from a slow file system does not take a round trip per page fault.
+    """
+    mm = getattr(bpf, '_map', None)
+    if mm is None or not hasattr(mm, 'madvise') or not hasattr(mmap, 'MADV_WILLNEED'):
+        return
+    try:
+        mm.madvise(mmap.MADV_WILLNEED)
+    except OSError as e:
+        _log.debug('could not prefetch binpickle file: %s', e)
+
+
+def _in_temp_dir(path):
+    "Query whether a file is in the configured ``LK_TEMP_DIR``."
+    tmp = os.environ.get('LK_TEMP_DIR', None)
+    if not tmp:
+        return False
+    return pathlib.Path(tmp).resolve() in pathlib.Path(path).resolve().parents
+
+
+# compressor names that select the Blosc codec
+_BLOSC_NAMES = ['blosclz', 'lz4', 'lz4hc', 'zlib', 'zstd']
+
+
+def _make_codec(compress):
+    "Resolve a compression setting into a binpickle codec."
+    if compress in _BLOSC_NAMES:
+        compress = ('blosc', {'name': compress})
+
+    name = compress[0] if isinstance(compress, (tuple, list)) else compress
+    if isinstance(name, str) and name not in binpickle.codecs.CODECS:
+        if name != 'blosc':
+            raise ValueError('unknown compression codec ' + name)
+        _log.warning('blosc is not available, compressing with gz')
+        compress = 'gz'
+
+    return binpickle.codecs.make_codec(compress, list_is_tuple=True)
+
+
+def persist_binpickle(model, dir=None, file=None, compress=None):
     """
     Persist a model using binpickle.
 
+    By default, the model is saved in binpickle's mappable format, so worker processes
+    can use its buffers without copying them.  Compressing the file gives up that
+    zero-copy loading in exchange for a smaller file, which can be faster when
+    ``LK_TEMP_DIR`` is on a slow network file system.
+
     Args:
         model: The model to persist.
         dir: The temporary directory for persisting the model object.
         file: The file in which to save the object.
+        compress:
+            The codec with which to compress the file, or ``None`` to save it uncompressed.
+            Can be a Blosc compressor name (e.g. ``zstd`` or ``lz4``), or any codec
+            specification accepted by :py:func:`binpickle.codecs.make_codec`.  Defaults
+            to the value of the ``LK_TEMP_COMPRESS`` environment variable.
 
     Returns:
         PersistedModel: The persisted object.
@@ -31,13 +84,33 @@ def persist_binpickle(model, dir=None, file=None):
         fd, path = tempfile.mkstemp(suffix='.bpk', prefix='lkpy-', dir=dir)
         os.close(fd)
         path = pathlib.Path(path)
-    _log.debug('persisting %s to %s', model, path)
-    with binpickle.BinPickler.mappable(path) as bp, sharing_mode():
+    if compress is None:
+        compress = os.environ.get('LK_TEMP_COMPRESS', None)
+
+    if compress:
+        codec = _make_codec(compress)
+        _log.debug('persisting %s to %s with %s', model, path, codec)
+        bp = binpickle.BinPickler.compressed(path, codec)
+    else:
+        _log.debug('persisting %s to %s', model, path)
+        bp = binpickle.BinPickler.mappable(path)
+    with bp, sharing_mode():
         bp.dump(model)
     return BPKPersisted(path)
 
 
 class BPKPersisted(PersistedModel):
+    """
+    A model persisted to a binpickle file.
+
+    The file is opened lazily by :meth:`get` in direct mode: binpickle memory-maps the
+    whole file read-only, and the model's buffers are views into that mapping rather
+    than copies.  Worker processes therefore share the model's pages through the OS
+    page cache (unless the file is compressed, in which case buffers are decompressed
+    into memory).  Files in ``LK_TEMP_DIR`` may be on a slower (e.g. network) file
+    system, so their mappings are prefetched into the page cache when they are opened.
+    """
+
     def __init__(self, path):
         self.path = path
         self.is_owner = True
@@ -48,6 +121,8 @@ class BPKPersisted(PersistedModel):
         if self._bpk_file is None:
             _log.debug('loading %s', self.path)
             self._bpk_file = binpickle.BinPickleFile(self.path, direct=True)
+            if _in_temp_dir(self.path):
+                _prefetch(self._bpk_file)
             self._model = self._bpk_file.load()
         return self._model
 
@@ -77,14 +152,16 @@ class BPKPersisted(PersistedModel):
             self.is_owner = False
 
     def __getstate__(self):
-        d = dict(self.__dict__)
-        d['_bpk_file'] = None
-        d['_model'] = None
-        if self.is_owner == 'transfer':
-            d['is_owner'] = True
-        else:
-            d['is_owner'] = False
-        return d
+        # only send the path; the receiving process re-opens the file itself
+        return {
+            'path': self.path,
+            'is_owner': True if self.is_owner == 'transfer' else False
+        }
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._bpk_file = None
+        self._model = None
 
     def __del___(self):
         self.close(False)
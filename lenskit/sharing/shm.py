@@ -1,5 +1,13 @@
 import logging
 import pickle
+import io
+import mmap
+import atexit
+import threading
+from collections import defaultdict, OrderedDict
+
+import numpy as np
+
 from . import sharing_mode, PersistedModel
 
 try:
@@ -14,6 +22,150 @@ if pickle.HIGHEST_PROTOCOL < 5:
 _log = logging.getLogger(__name__)
 
 
+# alignment of data in the shared memory slab
+_ALIGN = 64
+
+
+def _align(offset):
+    return -(-offset // _ALIGN) * _ALIGN
+
+
+def _bucket(nbytes):
+    "Round a size up to a power of two, and at least one page."
+    return max(1 << (nbytes - 1).bit_length(), mmap.PAGESIZE)
+
+
+class _ShmPool:
+    """
+    Pool of released shared memory blocks, for reuse by later :func:`persist_shm` calls
+    instead of creating and unlinking a block every time.  Blocks are bucketed by
+    power-of-two size; when the free blocks exceed ``limit`` bytes, the least recently
+    released blocks are unlinked.
+
+    Only blocks that no other process or live array can still see are pooled; pooled
+    blocks are kept closed, and re-opened by name when they are reused.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.size = 0
+        self.free = defaultdict(list)
+        self.lru = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, nbytes):
+        bucket = _bucket(nbytes)
+        if bucket > self.limit:
+            # too big to ever be pooled, so don't pay for rounding it up
+            return shm.SharedMemory(create=True, size=nbytes)
+
+        with self._lock:
+            blocks = self.free[bucket]
+            if blocks:
+                block = blocks.pop()
+                del self.lru[block.name]
+                self.size -= bucket
+                _log.debug('reusing %d-byte SHM block %s', bucket, block.name)
+                return shm.SharedMemory(name=block.name)
+
+        return shm.SharedMemory(create=True, size=bucket)
+
+    def release(self, block, reusable=True):
+        """
+        Close a block and return it to the pool, or unlink it if it cannot be reused.
+
+        Args:
+            block(SharedMemory): the block to release.
+            reusable(bool):
+                ``False`` if the block may still be in use elsewhere (e.g. its name has
+                been sent to another process).
+        """
+        bucket = block.size
+        try:
+            block.close()
+        except BufferError:
+            _log.debug('SHM block %s still has live arrays, not reusing', block.name)
+            reusable = False
+
+        if not reusable or bucket != _bucket(bucket) or bucket > self.limit:
+            _log.debug('unlinking %d-byte SHM block %s', bucket, block.name)
+            block.unlink()
+            return
+
+        with self._lock:
+            self.free[bucket].append(block)
+            self.lru[block.name] = block
+            self.size += bucket
+            while self.size > self.limit:
+                self._evict()
+
+    def clear(self):
+        with self._lock:
+            while self.lru:
+                self._evict()
+
+    def _evict(self):
+        name, block = self.lru.popitem(last=False)
+        self.free[block.size].remove(block)
+        self.size -= block.size
+        _log.debug('evicting %d-byte SHM block %s', block.size, name)
+        block.unlink()
+
+
+# keep up to 64 MiB of released blocks for reuse
+_shm_pool = _ShmPool(64 * 1024 * 1024)
+atexit.register(_shm_pool.clear)
+
+
+class _SharingPickler(pickle.Pickler):
+    """
+    Pickler that lays out the data of NumPy arrays in a shared memory slab, so the
+    pickle stream only carries the slab offset, dtype, and shape of each array.
+    Arrays containing Python objects are pickled normally.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.arrays = []
+        self.size = 0
+        self._array_ids = {}
+
+    def persistent_id(self, obj):
+        if type(obj) is not np.ndarray or obj.dtype.hasobject or obj.nbytes == 0:
+            return None
+
+        key = id(obj)
+        if key in self._array_ids:
+            return self._array_ids[key]
+
+        order = 'F' if obj.flags.f_contiguous and not obj.flags.c_contiguous else 'C'
+        offset = _align(self.size)
+        self.size = offset + obj.nbytes
+        # keeping the array alive also keeps its id from being reused while pickling
+        self.arrays.append((offset, order, obj))
+
+        pid = ('array', offset, obj.dtype, obj.shape, order)
+        self._array_ids[key] = pid
+        return pid
+
+
+class _SharingUnpickler(pickle.Unpickler):
+    """
+    Unpickler that reconstructs NumPy arrays on top of a shared memory slab.
+    """
+    def __init__(self, file, slab, **kwargs):
+        super().__init__(file, **kwargs)
+        self.slab = slab
+
+    def persistent_load(self, pid):
+        tag, offset, dtype, shape, order = pid
+        if tag != 'array':
+            raise pickle.UnpicklingError('unknown persistent ID ' + str(tag))
+        # build on a slice of the slab, so the array holds an export of the block and
+        # the block cannot be closed (or reused) while the array is alive
+        nbytes = int(np.prod(shape)) * dtype.itemsize
+        arr = np.frombuffer(self.slab[offset:offset + nbytes], dtype)
+        return arr.reshape(shape, order=order)
+
+
 def persist_shm(model, dir=None):
     """
     Persist a model using binpickle.
@@ -30,37 +182,49 @@ def persist_shm(model, dir=None):
 
     buffers = []
 
-    with sharing_mode():
-        data = pickle.dumps(model, protocol=5, buffer_callback=buffers.append)
-
-    total_size = sum(memoryview(b).nbytes for b in buffers)
-    _log.info('serialized %s to %d pickle bytes with %d buffers of %d bytes',
-              model, len(data), len(buffers), total_size)
-
-    if buffers:
-        # blit the buffers to the SHM block
-        memory = shm.SharedMemory(create=True, size=total_size)
-        cur_offset = 0
-        blocks = []
-        for buf in buffers:
-            ba = buf.raw()
-            blen = ba.nbytes
-            bend = cur_offset + blen
-            _log.debug('saving %d bytes', blen)
-            memory.buf[cur_offset:bend] = ba
-            blocks.append((cur_offset, bend))
-            cur_offset = bend
+    with sharing_mode(), io.BytesIO() as out:
+        p = _SharingPickler(out, protocol=5, buffer_callback=buffers.append)
+        p.dump(model)
+        data = out.getvalue()
+
+    # out-of-band buffers go in the slab after the arrays
+    total_size = p.size
+    blocks = []
+    for buf in buffers:
+        bstart = _align(total_size)
+        total_size = bstart + buf.raw().nbytes
+        blocks.append((bstart, total_size))
+
+    _log.info('serialized %s to %d pickle bytes with %d arrays and %d buffers of %d bytes',
+              model, len(data), len(p.arrays), len(buffers), total_size)
+
+    if total_size > 0:
+        memory = _shm_pool.acquire(total_size)
+        _fill_slab(memory, p.arrays, zip(buffers, blocks))
     else:
         memory = None
-        blocks = []
 
     return SHMPersisted(data, memory, blocks)
 
 
+def _fill_slab(memory, arrays, buffers):
+    "Copy arrays and out-of-band buffers into their places in a single SHM slab."
+    for offset, order, arr in arrays:
+        _log.debug('saving %d-byte array', arr.nbytes)
+        view = np.ndarray(arr.shape, arr.dtype, buffer=memory.buf, offset=offset, order=order)
+        np.copyto(view, arr)
+        del view
+    for buf, (bs, be) in buffers:
+        _log.debug('saving %d bytes', be - bs)
+        memory.buf[bs:be] = buf.raw()
+
+
 class SHMPersisted(PersistedModel):
     buffers = []
     _model = None
     memory = None
+    # whether the block's name has been sent elsewhere, so it cannot be reused
+    shared = False
 
     def __init__(self, data, memory, blocks):
         self.pickle_data = data
@@ -73,11 +237,14 @@ class SHMPersisted(PersistedModel):
         if self._model is None:
             _log.debug('loading model from shared memory')
             shm = self._open()
+            slab = shm.buf if shm is not None else None
             buffers = []
             for bs, be in self.blocks:
-                buffers.append(shm.buf[bs:be])
+                buffers.append(slab[bs:be] if slab is not None else b'')
 
-            self._model = pickle.loads(self.pickle_data, buffers=buffers)
+            with io.BytesIO(self.pickle_data) as data:
+                up = _SharingUnpickler(data, slab, buffers=buffers)
+                self._model = up.load()
 
         return self._model
 
@@ -87,22 +254,31 @@ class SHMPersisted(PersistedModel):
         _log.debug('releasing SHM buffers')
         self.buffers = None
         if self.memory is not None:
-            self.memory.close()
             if self.is_owner:
-                self.memory.unlink()
+                # return the block to the pool for later models to reuse, if we can
+                _shm_pool.release(self.memory, not self.shared)
                 self.is_owner = False
+            else:
+                self.memory.close()
             self.memory = None
 
+    def reclaim(self):
+        # the processes that could see the block are gone, so it can be pooled again
+        self.shared = False
+
     def _open(self):
         if self.shm_name and not self.memory:
             self.memory = shm.SharedMemory(name=self.shm_name)
         return self.memory
 
     def __getstate__(self):
+        # once pickled, another process may map the block, so it must not be reused
+        self.shared = True
         return {
             'pickle_data': self.pickle_data,
             'blocks': self.blocks,
             'shm_name': self.shm_name,
+            'shared': True,
             'is_owner': True if self.is_owner == 'transfer' else False
         }
 
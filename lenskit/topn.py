@@ -5,10 +5,11 @@ from collections import OrderedDict as od
 
 import numpy as np
 import pandas as pd
+from numba import njit
 
 from .metrics.topn import *
 from .util import Stopwatch
-from .util.parallel import invoker
+from .util.parallel import invoker, proc_count
 
 _log = logging.getLogger(__name__)
 
@@ -17,81 +18,287 @@ def _length(df, *args, **kwargs):
     return float(len(df))
 
 
-def _grouping_iter(df, cols, ksf=()):
-    # what key are we going to work on?
-    current = cols[0]
-    remaining = cols[1:]
+def _grouping_iter(df, keys):
+    # group by all keys at once; keys are column names or series aligned with df
+    for gk, gdf in df.groupby(list(keys), sort=False, observed=True):
+        if not isinstance(gk, tuple):
+            gk = (gk,)
+        yield gk, gdf
 
-    if not remaining:
-        # this is the last column. we group by it.
-        for gk, gdf in df.groupby(current):
-            yield ksf + (gk,), gdf.drop(columns=[current])
+
+def _key_index(df, cols):
+    "Make an index of the key columns ``cols`` of ``df``."
+    if len(cols) > 1:
+        return pd.MultiIndex.from_frame(df[cols])
     else:
-        # we have columns remaining, let's start grouping by this one
-        for v, subdf in df.groupby(current):
-            yield from _grouping_iter(subdf.drop(columns=[current]), remaining, ksf + (v,))
+        return pd.Index(df[cols[0]])
+
+
+@njit(nogil=True)
+def _list_stats(codes, hits, gains, n):
+    """
+    Compute per-list statistics in one pass over rows in list order.
+
+    Args:
+        codes(numpy.ndarray): the list code for each row (negative to skip the row).
+        hits(numpy.ndarray): whether each row is relevant.
+        gains(numpy.ndarray): the gain of each row.
+        n(int): the number of lists.
+
+    Returns:
+        tuple: the length, relevant count, reciprocal rank, and log2-discounted DCG
+        of each list.
+    """
+    counts = np.zeros(n, np.int64)
+    ngood = np.zeros(n)
+    rr = np.zeros(n)
+    dcg = np.zeros(n)
+    for i in range(len(codes)):
+        g = codes[i]
+        if g < 0:
+            continue
+        counts[g] += 1
+        rank = counts[g]
+        if hits[i]:
+            ngood[g] += 1
+            if rr[g] == 0:
+                rr[g] = 1.0 / rank
+        dcg[g] += gains[i] / max(np.log2(rank), 1.0)
+
+    return counts, ngood, rr, dcg
+
+
+def _bulk_stats(recs, truth, rec_key, truth_key):
+    """
+    Compute the per-list statistics used by the vectorized metric implementations.
+    The truth is joined to the recommendations once, and the statistics are computed
+    by a compiled kernel instead of calling a metric function for each list.
+
+    Returns:
+        tuple: the statistics frame, indexed by ``rec_key``, and the number of truth
+        items for each truth list, indexed by ``truth_key``.
+    """
+    has_rating = 'rating' in truth.columns
+    t_cols = truth_key + ['item']
+    tdf = truth[t_cols + ['rating']] if has_rating else truth[t_cols]
+    tdf = tdf.drop_duplicates(t_cols)
+    tdf = tdf.rename(columns={'rating': '_gain'})
+    merged = pd.merge(recs[rec_key + ['item']], tdf, on=t_cols, how='left', indicator=True)
+
+    codes, lists = pd.factorize(_key_index(merged, rec_key))
+    lists = lists.set_names(rec_key)
+    hits = (merged['_merge'] == 'both').values
+    gains = np.nan_to_num(merged['_gain'].values) if has_rating else hits.astype(np.float64)
+    nrecs, ngood, rr, dcg = _list_stats(codes, hits, gains, len(lists))
+
+    # the ideal DCG sorts each user's truth by decreasing rating, with missing ratings first
+    t_codes, t_lists = pd.factorize(_key_index(truth, truth_key))
+    t_lists = t_lists.set_names(truth_key)
+    if has_rating:
+        t_gains = truth['rating'].values.astype(np.float64)
+        order = np.lexsort((-np.where(np.isnan(t_gains), np.inf, t_gains), t_codes))
+        t_codes = t_codes[order]
+        t_gains = np.nan_to_num(t_gains[order])
+    else:
+        t_gains = np.ones(len(t_codes))
+    ntruth, _g, _r, ideal = _list_stats(t_codes, np.ones(len(t_codes), np.bool_), t_gains,
+                                        len(t_lists))
+
+    ug_cols = [c for c in rec_key if c not in truth_key]
+    tpos = t_lists.get_indexer(lists.droplevel(ug_cols) if ug_cols else lists)
+    if np.any(tpos < 0):
+        raise KeyError('no truth for list {}'.format(lists[np.argmin(tpos)]))
+    stats = pd.DataFrame({
+        'nrecs': nrecs, 'ngood': ngood, 'rr': rr, 'dcg': dcg,
+        'ntruth': ntruth[tpos], 'ideal': ideal[tpos]
+    }, index=lists)
+    return stats, pd.Series(ntruth, index=t_lists, name='ntruth')
+
+
+def _bulk_length(stats):
+    return stats['nrecs'].astype(np.float64)
+
+
+def _bulk_precision(stats):
+    return stats['ngood'] / stats['nrecs']
+
+
+def _bulk_recall(stats):
+    return stats['ngood'] / stats['ntruth']
+
 
+def _bulk_recip_rank(stats):
+    return stats['rr']
 
-def _rla_worker(model, req):
-    col, val = req
-    return model._compute_group(col, val)
+
+def _bulk_ndcg(stats):
+    return stats['dcg'] / stats['ideal']
+
+
+# vectorized implementations of the built-in metrics with their default options
+_bulk_metrics = {
+    _length: _bulk_length,
+    precision: _bulk_precision,
+    recall: _bulk_recall,
+    recip_rank: _bulk_recip_rank,
+    ndcg: _bulk_ndcg,
+}
+
+
+def _rla_worker(model, part):
+    return model._compute_group(part)
+
+
+def _shared_categories(*cols):
+    "Make a categorical type whose categories are all the values of some columns."
+    cats = pd.Index(np.concatenate([c.values for c in cols]))
+    return pd.CategoricalDtype(cats.unique().dropna())
+
+
+def _decategorize(index):
+    "Convert a categorical index to an index of the type of its categories."
+    if isinstance(index, pd.CategoricalIndex):
+        return index.astype(index.categories.dtype)
+    else:
+        return index
 
 
 class _RLAJob:
     def __init__(self, recs, truth, metrics):
         self.recs = recs
         self.truth = truth
-        self.metrics = metrics
+        self.names = [mn for (mf, mn, margs) in metrics]
+        self.bulk_metrics = [(_bulk_metrics[mf], mn) for (mf, mn, margs) in metrics
+                             if mf in _bulk_metrics and not margs]
+        self.metrics = [(mf, mn, margs) for (mf, mn, margs) in metrics
+                        if mf not in _bulk_metrics or margs]
 
     def prepare(self, group_cols):
         rec_key, truth_key = _df_keys(self.recs.columns, self.truth.columns, group_cols)
-        _log.info('collecting truth data')
-        truth_frames = dict((k, df.set_index('item'))
-                            for (k, df)
-                            in _grouping_iter(self.truth, truth_key))
-        _log.debug('found truth for %d users', len(truth_frames))
-        self.truth = truth_frames
         self.rec_key = rec_key
         self.truth_key = truth_key
+        # metrics only see the list data columns, so drop everything else once up front
+        self.value_cols = [c for c in self.recs.columns
+                           if c in RecListAnalysis.DEFAULT_SKIP_COLS and c not in rec_key]
+        self.recs = self.recs[rec_key + self.value_cols]
+        self._categorize_keys()
+        if self.metrics:
+            _log.info('indexing truth data')
+            # one sorted frame, sliced per list, instead of a frame for each user
+            tdf = self.truth.set_index(truth_key + ['item']).sort_index()
+            tkeys = tdf.index.droplevel('item')
+            starts = np.flatnonzero(~tkeys.duplicated())
+            ends = np.append(starts[1:], len(tkeys))
+            # truth lists are identified by integer code, indexing these lists
+            self.truth_groups = tkeys[starts]
+            self.truth_starts = starts
+            self.truth_ends = ends
+            self.truth_items = tdf.reset_index(truth_key, drop=True)
+            _log.debug('found truth for %d users', len(starts))
+
+    def _categorize_keys(self):
+        """
+        Convert object (e.g. string) key columns to categoricals, so grouping and joining
+        work on integer codes instead of hashing the objects every time.  Truth key
+        columns get the same categories in both frames.
+        """
+        obj_cols = [c for c in self.rec_key if self.recs[c].dtype == object]
+        t_types = dict((c, _shared_categories(self.recs[c], self.truth[c]))
+                       for c in obj_cols
+                       if c in self.truth_key and self.truth[c].dtype == object)
+        r_types = dict((c, 'category') for c in obj_cols if c not in self.truth_key)
+        r_types.update(t_types)
+        self.cat_cols = [c for c in obj_cols if c in r_types]
+
+        if self.cat_cols:
+            _log.debug('converting key columns %s to categoricals', self.cat_cols)
+            self.recs = self.recs.astype(r_types)
+            self.truth = self.truth.astype(t_types)
+
+    def _restore_index(self, index):
+        """
+        Convert categorical key levels (including those :meth:`_categorize_keys` made)
+        back to the type of their values.
+        """
+        if isinstance(index, pd.MultiIndex):
+            return index.set_levels([_decategorize(lvl) for lvl in index.levels])
+        else:
+            return _decategorize(index)
 
     def compute(self, n_jobs=None):
-        first = self.rec_key[0]
-        bins = self.recs.groupby(first)['item'].count()
-        total = bins.sum()
-        _log.debug('info RLA for %d rows in %d bins', total, len(bins))
-        if total < 1000 or len(bins) < 4:
+        _log.debug('computing %d vectorized metrics', len(self.bulk_metrics))
+        stats, tcounts = _bulk_stats(self.recs, self.truth, self.rec_key, self.truth_key)
+        # per-list metrics use the truth index built by prepare, so don't ship the frame too
+        self.truth = None
+        tcounts.index = self._restore_index(tcounts.index)
+        self.truth_counts = tcounts
+        res = pd.DataFrame(dict((mn, mf(stats)) for (mf, mn) in self.bulk_metrics),
+                           index=self._restore_index(stats.index))
+
+        if self.metrics:
+            _log.debug('computing %d per-list metrics', len(self.metrics))
+            res = res.join(self._compute_lists(n_jobs))
+
+        return res[self.names]
+
+    def _compute_lists(self, n_jobs):
+        if n_jobs is None:
+            n_jobs = proc_count(max_default=4)
+        codes, lists = pd.factorize(_key_index(self.recs, self.rec_key))
+        if len(self.recs) < 1000 or len(lists) < 4:
             n_jobs = 1  # force in-process for small runs
 
+        # spread the lists round-robin over a few bins per worker, so the work is
+        # balanced no matter how many distinct values the first key column has
+        nbins = min(n_jobs * 4, len(lists)) if n_jobs > 1 else 1
+        self.list_bins = codes % nbins
+        _log.debug('computing %d lists in %d bins', len(lists), nbins)
+
         with invoker(self, _rla_worker, n_jobs) as loop:
-            res = loop.map((first, v) for v in bins.index.values)
+            res = loop.map(range(nbins))
             res = pd.concat(res, ignore_index=True)
 
         return res.set_index(self.rec_key)
 
-    def _compute_group(self, col, val):
-        _log.debug('computing for %s=%s', col, val)
-        mnames = [mn for (mf, mn, margs) in self.metrics]
-        gen = self._iter_measurements(col, val)
-        return pd.DataFrame.from_records(gen, columns=self.rec_key + mnames)
-
-    def _iter_measurements(self, col, val):
-        key = self.rec_key[1:]
-        df = self.recs[self.recs[col] == val]
-        df = df.drop(columns=[col])
-        nt = len(self.truth_key)
-        if key:
-            for rk, gdf in _grouping_iter(df, key):
-                rk = (val,) + rk
-                tk = rk[-nt:]
-                g_truth = self.truth[tk]
-                results = tuple(mf(gdf, g_truth, **margs) for (mf, mn, margs) in self.metrics)
-                yield rk + results
-        else:
-            # we only have one group level
-            tk = (val,)
-            g_truth = self.truth[tk]
-            results = tuple(mf(df, g_truth, **margs) for (mf, mn, margs) in self.metrics)
-            yield tk + results
+    def _compute_group(self, part):
+        _log.debug('computing for bin %d', part)
+        df = self.recs[self.list_bins == part]
+
+        # every list has at least one row, so the row count bounds the list count
+        n = len(df)
+        keys = [np.empty(n, dtype=object) for k in self.rec_key]
+        values = [np.empty(n, dtype=object) for m in self.metrics]
+        i = 0
+        for rk, results in self._iter_measurements(df):
+            for kc, kv in zip(keys, rk):
+                kc[i] = kv
+            for vc, v in zip(values, results):
+                vc[i] = np.nan if v is None else v
+            i += 1
+
+        cols = dict((k, kc[:i]) for (k, kc) in zip(self.rec_key, keys))
+        cols.update((mn, vc[:i]) for ((mf, mn, margs), vc) in zip(self.metrics, values))
+        # metrics may return any type, so let pandas pick each column's type from its values
+        return pd.DataFrame(cols).infer_objects()
+
+    def _iter_measurements(self, df):
+        nk = len(self.rec_key) - len(self.truth_key)
+        # map each row to its truth list's code, and group by that instead of the truth key
+        tcodes = self.truth_groups.get_indexer(_key_index(df, self.truth_key))
+        if np.any(tcodes < 0):
+            missing = df[self.rec_key].iloc[np.argmin(tcodes)]
+            raise KeyError('no truth for list {}'.format(tuple(missing)))
+        keys = [df[c] for c in self.rec_key[:nk]]
+        keys.append(pd.Series(tcodes, index=df.index))
+
+        for gk, gdf in _grouping_iter(df[self.value_cols], keys):
+            code = gk[-1]
+            rk = gk[:-1]
+            tk = self.truth_groups[code]
+            if not isinstance(tk, tuple):
+                tk = (tk,)
+            g_truth = self.truth_items.iloc[self.truth_starts[code]:self.truth_ends[code]]
+            yield rk + tk, tuple(mf(gdf, g_truth, **margs) for (mf, mn, margs) in self.metrics)
 
 
 class RecListAnalysis:
@@ -120,6 +327,12 @@ class RecListAnalysis:
     Args:
         group_cols(list):
             The columns to group by, or ``None`` to use the default.
+        n_jobs(int or None):
+            The number of processes to use for metrics that are computed one list at a
+            time, or ``None`` for the default (see :func:`lenskit.util.parallel.invoker`).
+            Large analyses send those metrics (and their arguments) to worker processes,
+            so they must be picklable (e.g. module-level functions, not lambdas), unless
+            ``n_jobs`` is 1.
     """
 
     DEFAULT_SKIP_COLS = ['item', 'rank', 'score', 'rating']
@@ -135,7 +348,9 @@ class RecListAnalysis:
 
         A metric is a function of two arguments: the a single group of the recommendation
         frame, and the corresponding truth frame.  The truth frame will be indexed by
-        item ID.  The recommendation frame will be in the order in the data.  Many metrics
+        item ID.  The recommendation frame will be in the order in the data, and only has
+        whichever of the ``item``, ``rank``, ``score``, and ``rating`` columns are present
+        (other non-grouping columns are not passed to metrics).  Many metrics
         are defined in :mod:`lenskit.metrics.topn`; they are re-exported from
         :mod:`lenskit.topn` for convenience.
 
@@ -179,15 +394,18 @@ class RecListAnalysis:
         if include_missing:
             _log.info('filling in missing user info')
             ug_cols = [c for c in job.rec_key if c not in job.truth_key]
-            tcount = truth.reset_index().groupby(job.truth_key)['item'].count()
-            tcount.name = 'ntruth'
+            # the analysis already counted the truth items for each list
+            tcount = job.truth_counts
             _log.debug('res index levels: %s', res.index.names)
             if ug_cols:
-                _log.debug('regrouping by %s to fill', ug_cols)
-                res = res.groupby(level=ug_cols).apply(lambda f: f.reset_index(ug_cols, drop=True).join(tcount, how='outer'))
+                _log.debug('crossing %s with truth keys to fill', ug_cols)
+                full = _cross_index(res.index.droplevel(job.truth_key).unique(), tcount.index)
             else:
-                _log.debug('no ungroup cols, directly merging to fill')
-                res = res.join(tcount, how='outer')
+                _log.debug('no ungroup cols, directly reindexing to fill')
+                full = tcount.index
+            res = res.reindex(full.union(res.index)).sort_index()
+            t_idx = res.index.droplevel(ug_cols) if ug_cols else res.index
+            res['ntruth'] = tcount.reindex(t_idx).values
             _log.debug('final columns: %s', res.columns)
             _log.debug('index levels: %s', res.index.names)
             res['ntruth'] = res['ntruth'].fillna(0)
@@ -196,6 +414,16 @@ class RecListAnalysis:
         return res
 
 
+def _cross_index(left, right):
+    "Make an index of every combination of the entries of ``left`` and ``right``."
+    nl, nr = len(left), len(right)
+    left = left[np.repeat(np.arange(nl), nr)]
+    right = right[np.tile(np.arange(nr), nl)]
+    arrays = [left.get_level_values(i) for i in range(left.nlevels)]
+    arrays += [right.get_level_values(i) for i in range(right.nlevels)]
+    return pd.MultiIndex.from_arrays(arrays, names=list(left.names) + list(right.names))
+
+
 def _df_keys(r_cols, t_cols, g_cols=None, skip_cols=RecListAnalysis.DEFAULT_SKIP_COLS):
     "Identify rec list and truth list keys."
     if g_cols is None:
@@ -244,6 +244,13 @@ def invoker(model, func, n_jobs=None, *, persist_method=None):
         return MPOpInvoker(model, func, n_jobs, persist_method)
 
 
+def _close_persisted(key):
+    "Release a model an invoker persisted, once its worker processes have exited."
+    if key is not None:
+        key.reclaim()
+        key.close()
+
+
 class ModelOpInvoker(ABC):
     """
     Interface for invoking operations on a model, possibly in parallel.  The operation
@@ -299,8 +306,10 @@ class ProcessPoolOpInvoker(ModelOpInvoker):
     def __init__(self, model, func, n_jobs, persist_method):
         if isinstance(model, PersistedModel):
             key = model
+            self.persisted = None
         else:
             key = persist(model, method=persist_method)
+            self.persisted = key
         func = pickle.dumps(func)
         ctx = LKContext.INSTANCE
         _log.info('setting up ProcessPoolExecutor w/ %d workers', n_jobs)
@@ -315,14 +324,17 @@ class ProcessPoolOpInvoker(ModelOpInvoker):
     def shutdown(self):
         self.executor.shutdown()
         os.environ.pop('_LK_IN_MP', 'yes')
+        _close_persisted(self.persisted)
 
 
 class MPOpInvoker(ModelOpInvoker):
     def __init__(self, model, func, n_jobs, persist_method):
         if isinstance(model, PersistedModel):
             key = model
+            self.persisted = None
         else:
             key = persist(model, method=persist_method)
+            self.persisted = key
         func = pickle.dumps(func)
         ctx = LKContext.INSTANCE
         kid_tc = proc_count(level=1)
@@ -336,4 +348,6 @@ class MPOpInvoker(ModelOpInvoker):
 
     def shutdown(self):
         self.pool.close()
+        self.pool.join()
         os.environ.pop('_LK_IN_MP', 'yes')
+        _close_persisted(self.persisted)
@@ -6,7 +6,7 @@ import numpy as np
 from lenskit.util.parallel import invoker, proc_count, run_sp, is_worker, is_mp_worker
 from lenskit.util.test import set_env_var
 from lenskit.util.random import get_root_seed, _have_gen
-from lenskit.sharing import persist_binpickle
+from lenskit.sharing import persist_binpickle, SHM_AVAILABLE
 
 from pytest import mark, raises
 
@@ -33,6 +33,22 @@ def test_invoke_matrix(n_jobs):
             assert np.all(rv == act_rv)
 
 
+@mark.skipif(not SHM_AVAILABLE, reason='shared_memory not available')
+def test_invoke_reuse_shm():
+    "Invokers release their models when done, so the next one can reuse the memory"
+    matrix = np.random.randn(100, 100)
+    vectors = [np.random.randn(100) for i in range(10)]
+    with invoker(matrix, _mul_op, 2, persist_method='shm') as inv:
+        list(inv.map(vectors))
+        name = inv.persisted.shm_name
+
+    with invoker(matrix + 1, _mul_op, 2, persist_method='shm') as inv:
+        assert inv.persisted.shm_name == name
+        mults = inv.map(vectors)
+        for rv, v in zip(mults, vectors):
+            assert np.all(rv == (matrix + 1) @ v)
+
+
 def test_mp_is_worker():
     with invoker('foo', _worker_status, 2) as loop:
         res = list(loop.map(range(10)))
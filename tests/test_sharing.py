@@ -1,4 +1,5 @@
 import os
+import sys
 
 import pickle
 import numpy as np
@@ -6,8 +7,9 @@ import numpy as np
 import lenskit.util.test as lktu
 from lenskit import sharing as lks
 from lenskit.algorithms.als import BiasedMF
+from lenskit.sharing.shm import _ShmPool
 
-from pytest import mark
+from pytest import mark, raises
 
 
 def test_sharing_mode():
@@ -28,6 +30,34 @@ def test_persist_bpk():
         m2 = share.get()
         assert m2 is not matrix
         assert np.all(m2 == matrix)
+        # the loaded array should be a view of the mapped file, not a copy
+        assert not m2.flags.owndata
+        assert not m2.flags.writeable
+        del m2
+    finally:
+        share.close()
+
+
+def test_persist_bpk_compressed():
+    matrix = np.random.randn(1000, 100)
+    share = lks.persist_binpickle(matrix, compress='gz')
+    try:
+        m2 = share.get()
+        assert m2 is not matrix
+        assert np.all(m2 == matrix)
+        del m2
+    finally:
+        share.close()
+
+
+def test_persist_bpk_compress_env():
+    "Test compression configured with an environment variable"
+    matrix = np.random.randn(1000, 100)
+    with lktu.set_env_var('LK_TEMP_COMPRESS', 'zstd'):
+        share = lks.persist_binpickle(matrix)
+    try:
+        m2 = share.get()
+        assert np.all(m2 == matrix)
         del m2
     finally:
         share.close()
@@ -46,6 +76,74 @@ def test_persist_shm():
         share.close()
 
 
+@mark.skipif(not lks.SHM_AVAILABLE, reason='shared_memory not available')
+def test_persist_shm_reuse():
+    "Test that closed shared memory blocks are reused"
+    matrix = np.random.randn(1000, 100)
+    share = lks.persist_shm(matrix)
+    name = share.shm_name
+    share.close()
+
+    share = lks.persist_shm(matrix + 1)
+    try:
+        assert share.shm_name == name
+        m2 = share.get()
+        assert np.all(m2 == matrix + 1)
+        del m2
+    finally:
+        share.close()
+
+
+@mark.skipif(not lks.SHM_AVAILABLE, reason='shared_memory not available')
+def test_persist_shm_live_arrays():
+    "Blocks with arrays still in use must not be reused and overwritten"
+    matrix = np.random.randn(1000, 100)
+    share = lks.persist_shm(matrix)
+    m2 = share.get()
+    share.close()
+
+    share = lks.persist_shm(matrix + 1)
+    try:
+        assert np.all(m2 == matrix)
+        m3 = share.get()
+        assert np.all(m3 == matrix + 1)
+        del m3
+    finally:
+        share.close()
+
+
+@mark.skipif(not lks.SHM_AVAILABLE, reason='shared_memory not available')
+def test_persist_shm_pickled_not_reused():
+    "Blocks sent to other processes must not be reused"
+    matrix = np.random.randn(1000, 100)
+    share = lks.persist_shm(matrix)
+    name = share.shm_name
+    copy = pickle.loads(pickle.dumps(share))
+    m2 = copy.get()
+    share.close()
+
+    share = lks.persist_shm(matrix + 1)
+    try:
+        assert share.shm_name != name
+        assert np.all(m2 == matrix)
+    finally:
+        share.close()
+        del m2
+        copy.close()
+
+
+@mark.skipif(not lks.SHM_AVAILABLE, reason='shared_memory not available')
+def test_shm_pool_large_exact():
+    "Blocks too big to pool are not rounded up"
+    pool = _ShmPool(64 * 1024)
+    block = pool.acquire(100 * 1024 + 8)
+    try:
+        assert block.size == 100 * 1024 + 8
+    finally:
+        pool.release(block)
+    assert pool.size == 0
+
+
 def test_persist():
     "Test default persistence"
     matrix = np.random.randn(1000, 100)
@@ -91,6 +189,28 @@ def test_persist_method():
         share.close()
 
 
+def test_persist_bad_method():
+    "Unknown persistence methods should be reported"
+    with raises(ValueError, match='frobnicate.*noop'):
+        lks.persist(np.random.randn(10), method='frobnicate')
+
+
+def test_persist_noop():
+    "Test no-op persistence"
+    matrix = np.random.randn(1000, 100)
+
+    share = lks.persist(matrix, method='noop')
+    assert isinstance(share, lks.NoopPersisted)
+    try:
+        assert share.get() is matrix
+        s2 = pickle.loads(pickle.dumps(share))
+        assert not s2.is_owner
+        assert np.all(s2.get() == matrix)
+    finally:
+        share.close()
+    assert share.get() is None
+
+
 def test_store_als():
     algo = BiasedMF(10)
     algo.fit(lktu.ml_test.ratings)
@@ -110,3 +230,82 @@ def test_store_als():
         del k2
     finally:
         shared.close()
+
+
+@mark.skipif(not lks.SHM_AVAILABLE, reason='shared_memory not available')
+def test_persist_shm_arrays():
+    "Test shared memory persistence with assorted array layouts"
+    matrix = np.random.randn(100, 50)
+    data = {
+        'matrix': matrix,
+        'transposed': matrix.T,
+        'empty': np.empty(0),
+        'objects': np.array(['a', 'b', None], dtype=object),
+    }
+    share = lks.persist_shm(data)
+    try:
+        d2 = share.get()
+        assert d2 is not data
+        for k, v in data.items():
+            assert d2[k].shape == v.shape
+            assert d2[k].dtype == v.dtype
+            assert np.all(d2[k] == v)
+        del d2
+    finally:
+        share.close()
+
+
+def test_bpk_pickle_path_only():
+    "Pickling a binpickle-persisted model should only send the path"
+    matrix = np.random.randn(1000, 100)
+    share = lks.persist_binpickle(matrix)
+    try:
+        share.get()
+        data = pickle.dumps(share)
+        assert len(data) < 1000
+
+        s2 = pickle.loads(data)
+        assert s2.path == share.path
+        assert not s2.is_owner
+        assert np.all(s2.get() == matrix)
+        s2.close()
+    finally:
+        share.close()
+
+
+def test_bpk_prefetch(tmp_path, monkeypatch):
+    "Files are only prefetched when they live in a configured temporary directory"
+    bpk_mod = sys.modules['lenskit.sharing.binpickle']
+    prefetched = []
+    monkeypatch.setattr(bpk_mod, '_prefetch', prefetched.append)
+
+    matrix = np.random.randn(1000, 100)
+    with lktu.set_env_var('LK_TEMP_DIR', None):
+        share = lks.persist_binpickle(matrix)
+        try:
+            assert np.all(share.get() == matrix)
+            assert not prefetched
+        finally:
+            share.close()
+
+    temp_dir = tmp_path / 'temp'
+    temp_dir.mkdir()
+    with lktu.set_env_var('LK_TEMP_DIR', os.fspath(temp_dir)):
+        share = lks.persist_binpickle(matrix, dir=tmp_path)
+        try:
+            assert np.all(share.get() == matrix)
+            assert not prefetched
+        finally:
+            share.close()
+
+        share = lks.persist_binpickle(matrix)
+        try:
+            assert np.all(share.get() == matrix)
+            assert prefetched == [share._bpk_file]
+            # the real prefetch should accept the opened file
+            monkeypatch.undo()
+            bpk_mod._prefetch(share._bpk_file)
+            # and do nothing if binpickle's internals change
+            bpk_mod._prefetch(object())
+        finally:
+            share.close()
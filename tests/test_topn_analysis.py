@@ -3,7 +3,7 @@ import logging
 import numpy as np
 import pandas as pd
 
-from pytest import approx, mark
+from pytest import approx, mark, raises
 
 from lenskit.algorithms.user_knn import UserUser
 from lenskit.algorithms.item_knn import ItemItem
@@ -15,6 +15,39 @@ from lenskit import topn, batch, crossfold as xf
 _log = logging.getLogger(__name__)
 
 
+# per-list wrappers of the built-in metrics, defined here so they can be pickled
+def _list_precision(recs, truth):
+    return topn.precision(recs, truth)
+
+
+def _list_recall(recs, truth):
+    return topn.recall(recs, truth)
+
+
+def _list_recip_rank(recs, truth):
+    return topn.recip_rank(recs, truth)
+
+
+def _list_ndcg(recs, truth):
+    return topn.ndcg(recs, truth)
+
+
+def _list_length(recs, truth):
+    return len(recs)
+
+
+def _list_top(recs, truth):
+    return str(recs['item'].iloc[0])
+
+
+_list_metrics = {
+    'precision': _list_precision,
+    'recall': _list_recall,
+    'recip_rank': _list_recip_rank,
+    'ndcg': _list_ndcg,
+}
+
+
 def test_split_keys():
     rla = topn.RecListAnalysis()
     recs, truth = topn._df_keys(['algorithm', 'user', 'item', 'rank', 'score'],
@@ -239,6 +272,78 @@ def test_java_equiv():
     assert umm['err'].values == approx(0, abs=1.0e-6)
 
 
+@mark.parametrize('n_jobs', [1, 2])
+def test_bulk_equiv(n_jobs):
+    "The vectorized metrics should match calling the metric functions per list"
+    dir = Path(__file__).parent
+    recs = pd.read_csv(str(dir / 'topn-java-recs.csv'))
+    truth = pd.read_csv(str(dir / 'topn-java-truth.csv'))
+
+    bulk = topn.RecListAnalysis()
+    lists = topn.RecListAnalysis(n_jobs=n_jobs)
+    for name, metric in _list_metrics.items():
+        bulk.add_metric(getattr(topn, name))
+        lists.add_metric(metric, name=name)
+
+    bres = bulk.compute(recs, truth)
+    lres = lists.compute(recs, truth)
+    assert list(bres.columns) == list(lres.columns)
+    bres, lres = bres.align(lres)
+    for col in bres.columns:
+        assert bres[col].values == approx(lres[col].values)
+
+
+def test_custom_metric_types():
+    "Per-list metrics keep the types of their results"
+    rla = topn.RecListAnalysis()
+    rla.add_metric(_list_length, name='length')
+    rla.add_metric(_list_top, name='top')
+
+    recs = pd.DataFrame({'user': [1, 1, 2], 'item': [2, 3, 4]})
+    truth = pd.DataFrame({'user': [1, 2], 'item': [2, 5]})
+
+    res = rla.compute(recs, truth)
+    assert res['length'].dtype == np.int64
+    assert res.loc[1, 'length'] == 2
+    assert res.loc[2, 'length'] == 1
+    assert res.loc[1, 'top'] == '2'
+    assert res.loc[2, 'top'] == '4'
+
+
+@mark.parametrize('custom', [False, True])
+def test_missing_truth(custom):
+    "Lists with no truth should fail the same way whichever metrics are used"
+    rla = topn.RecListAnalysis()
+    rla.add_metric(topn.precision)
+    if custom:
+        rla.add_metric(_list_recall, name='recall')
+
+    recs = pd.DataFrame({'user': ['u1', 'u1', 'u2'], 'item': [2, 3, 4]})
+    truth = pd.DataFrame({'user': ['u1', 'u1'], 'item': [1, 2], 'rating': [3.0, 5.0]})
+
+    with raises(KeyError, match='u2'):
+        rla.compute(recs, truth)
+
+
+@mark.parametrize('categorical', [False, True])
+def test_fill_users_order(categorical):
+    "Filled-in users should be sorted in, and keep the type of the user key"
+    rla = topn.RecListAnalysis()
+    rla.add_metric(topn.precision)
+
+    recs = pd.DataFrame({'user': [1, 1, 2, 5, 9], 'item': [1, 2, 3, 4, 5]})
+    truth = pd.DataFrame({'user': [1, 2, 5, 7, 9], 'item': [1, 3, 9, 9, 5]})
+    if categorical:
+        recs['user'] = recs['user'].astype('category')
+        truth['user'] = truth['user'].astype('category')
+
+    scores = rla.compute(recs, truth, include_missing=True)
+    assert list(scores.index) == [1, 2, 5, 7, 9]
+    assert scores.index.dtype == np.int64
+    assert scores.loc[7, 'nrecs'] == 0
+    assert scores.loc[7, 'ntruth'] == 1
+
+
 @mark.slow
 def test_fill_users():
     rla = topn.RecListAnalysis()